@@ -1,52 +1,182 @@
 from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, session
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')  # Không cần GUI
-from datetime import datetime
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, timedelta
 import io
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 import requests
-import json
+import orjson
 import os
+import atexit
+import sqlite3
+import threading
+import queue
+import time
+from functools import lru_cache
+
+from models import db, User, SensorData, ensure_indexes, get_database_url
+
+class OrjsonProvider(DefaultJSONProvider):
+    # orjson nhanh hơn json chuẩn. Khác biệt so với provider mặc định:
+    # datetime được xuất dạng ISO 8601 (không phải HTTP-date), và chuỗi luôn
+    # là UTF-8 thay vì escape \uXXXX (ensure_ascii không có tác dụng).
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        default = kwargs.get('default', self.default)
+        return orjson.dumps(obj, default=default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        # Session cookie truyền object_hook để giải tag (tuple, bytes, flash);
+        # orjson không hỗ trợ nên để provider mặc định xử lý
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'your-secret-key-here-change-this'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///classguard.db'
+database_url = get_database_url()
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not database_url.startswith('sqlite'):
+    # Giữ kết nối lâu dài, kiểm tra trước khi dùng và làm mới trước khi
+    # Postgres quản lý cắt kết nối nhàn rỗi
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 5,
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+    }
 
-db = SQLAlchemy(app)
+# Template không đổi khi chạy production: bỏ kiểm tra file mỗi lần render
+# và lưu template đã biên dịch ra thư mục tạm
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+db.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# ================== MÔ HÌNH DỮ LIỆU ==================
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
-    role = db.Column(db.String(20), default='viewer')  # 'admin' hoặc 'viewer'
+# Render/Fly đặt proxy phía trước: lấy IP client từ X-Forwarded-For, nếu
+# không mọi người dùng sẽ chung một giới hạn đăng nhập theo IP của proxy
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+limiter = Limiter(get_remote_address, app=app, storage_uri='memory://')
+
+# WAL cho phép đọc song song với luồng ghi; NORMAL bớt fsync mỗi commit
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
 
-class SensorData(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    temperature = db.Column(db.Float)
-    humidity = db.Column(db.Float)
-    light = db.Column(db.Float)
-    air_quality = db.Column(db.Float)
-    sound_level = db.Column(db.Float)
-    evaluation = db.Column(db.String(50))
-    device_ip = db.Column(db.String(50))
+# ================== GHI DỮ LIỆU THEO LÔ ==================
+# Request chỉ đẩy bản ghi vào hàng đợi; luồng nền gom và ghi một lần mỗi
+# giây (hoặc khi đủ _WRITE_BATCH_SIZE bản ghi) để fsync của SQLite không
+# chặn việc trả dữ liệu cho dashboard.
+_WRITE_BATCH_SIZE = 100
+_WRITE_INTERVAL = 1.0
+
+_write_q = queue.Queue(maxsize=10_000)
+_writer_lock = threading.Lock()
+_writer_thread = None
+_WRITER_STOP = object()
+
+def queue_sensor_data(sensor_data):
+    global _writer_thread
+    if _writer_thread is None or not _writer_thread.is_alive():
+        with _writer_lock:
+            if _writer_thread is None or not _writer_thread.is_alive():
+                if _writer_thread is not None:
+                    print("Luồng ghi dữ liệu cảm biến đã dừng, khởi động lại")
+                _writer_thread = threading.Thread(target=_sensor_writer, daemon=True)
+                _writer_thread.start()
+    
+    _enqueue(sensor_data)
+
+def _enqueue(item):
+    while True:
+        try:
+            _write_q.put_nowait(item)
+            return
+        except queue.Full:
+            # Hàng đợi đầy: bỏ bản ghi cũ nhất
+            try:
+                _write_q.get_nowait()
+                print("Hàng đợi ghi dữ liệu cảm biến đầy, bỏ bản ghi cũ nhất")
+            except queue.Empty:
+                pass
+
+def _sensor_writer():
+    stopping = False
+    while not stopping:
+        item = _write_q.get()
+        if item is _WRITER_STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + _WRITE_INTERVAL
+        while len(batch) < _WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _write_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _WRITER_STOP:
+                stopping = True
+                break
+            batch.append(item)
+        
+        # Bọc cả app context và rollback: một lô lỗi (kể cả khi kết nối đã
+        # chết) không được làm dừng luồng ghi
+        try:
+            with app.app_context():
+                try:
+                    db.session.bulk_save_objects(batch)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+        except Exception as e:
+            print(f"Lỗi ghi dữ liệu cảm biến: {e}")
+
+@atexit.register
+def _drain_sensor_writer():
+    # Worker tắt (deploy, restart): ghi nốt các bản ghi còn trong hàng đợi
+    # trước khi luồng daemon bị huỷ
+    if _writer_thread is None or not _writer_thread.is_alive():
+        return
+    _enqueue(_WRITER_STOP)
+    _writer_thread.join(timeout=10)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Flask-Login đã cache current_user trong mỗi request; session.get còn
+    # tra identity map trước khi truy vấn và tránh Query.get đã bị deprecate
+    return db.session.get(User, int(user_id))
 
 # ================== TRANG ĐĂNG NHẬP ==================
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('5/minute', methods=['POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -75,17 +205,46 @@ def dashboard():
     return render_template('dashboard.html', user=current_user)
 
 # ================== API LẤY DỮ LIỆU ==================
+# Nhiều trình duyệt cùng poll một ESP32: giữ kết quả đọc gần nhất trong
+# _ESP_CACHE_TTL giây để không gọi lại thiết bị và ghi trùng bản ghi.
+_ESP_CACHE_TTL = 2.0
+_esp_cache = {}  # esp_ip -> (thời điểm đọc, dữ liệu)
+
+# Dữ liệu mẫu trả về khi không kết nối được ESP32
+_SAMPLE_DATA = {
+    'temperature': 25.5,
+    'humidity': 65.2,
+    'light': 450.0,
+    'air_quality': 350.0,
+    'sound_level': 55.0,
+    'evaluation': 'Tốt',
+    'led_state': True,
+    'fan_state': False,
+    'auto_mode': True
+}
+
 @app.route('/api/data')
 @login_required
 def get_data():
     # Lấy dữ liệu từ ESP32 (thay IP bằng IP thật của ESP32)
     try:
         esp_ip = request.args.get('esp_ip', '192.168.1.100')
+        
+        # fresh=1: dashboard vừa gửi lệnh điều khiển. Cache nằm riêng trong
+        # từng worker nên /api/control chỉ xoá được entry của worker nhận nó;
+        # đọc thẳng từ ESP32 để không hiện lại trạng thái trước lệnh
+        fresh = request.args.get('fresh') == '1'
+        cached = _esp_cache.get(esp_ip)
+        if not fresh and cached and time.monotonic() - cached[0] < _ESP_CACHE_TTL:
+            return jsonify(cached[1])
+        
         response = requests.get(f'http://{esp_ip}/data', timeout=5)
-        data = response.json()
+        data = orjson.loads(response.content)
         
-        # Lưu vào database
+        # Lưu vào database. Gán timestamp lúc nhận, vì luồng ghi theo lô chỉ
+        # flush sau đó và default của cột sẽ lấy thời điểm flush
         sensor_data = SensorData(
+            timestamp=datetime.utcnow(),
             temperature=data['temperature'],
             humidity=data['humidity'],
             light=data['light'],
@@ -94,23 +253,21 @@ def get_data():
             evaluation=data['evaluation'],
             device_ip=esp_ip
         )
-        db.session.add(sensor_data)
-        db.session.commit()
+        queue_sensor_data(sensor_data)
+        
+        # esp_ip do người dùng gửi lên: dọn các entry đã hết hạn để cache
+        # không phình mãi
+        now = time.monotonic()
+        for ip, (fetched_at, _) in list(_esp_cache.items()):
+            if now - fetched_at >= _ESP_CACHE_TTL:
+                _esp_cache.pop(ip, None)
+        # Thay cả tuple một lần để request khác không đọc phải entry dở dang
+        _esp_cache[esp_ip] = (now, data)
         
         return jsonify(data)
     except:
         # Nếu không kết nối được ESP32, trả về dữ liệu mẫu
-        return jsonify({
-            'temperature': 25.5,
-            'humidity': 65.2,
-            'light': 450.0,
-            'air_quality': 350.0,
-            'sound_level': 55.0,
-            'evaluation': 'Tốt',
-            'led_state': True,
-            'fan_state': False,
-            'auto_mode': True
-        })
+        return jsonify(_SAMPLE_DATA)
 
 # ================== API ĐIỀU KHIỂN ==================
 @app.route('/api/control', methods=['POST'])
@@ -129,6 +286,11 @@ def control_device():
         return jsonify({'message': 'Thành công', 'response': response.text})
     except:
         return jsonify({'error': 'Không thể kết nối đến thiết bị'}), 500
+    finally:
+        # Trạng thái thiết bị có thể đã đổi: bỏ dữ liệu đã cache của worker
+        # này sau khi lệnh xong, để poll chạy song song không cache lại trạng
+        # thái cũ. Worker khác được xử lý bằng poll fresh=1 từ dashboard.
+        _esp_cache.pop(esp_ip, None)
 
 # ================== LỊCH SỬ DỮ LIỆU ==================
 @app.route('/history')
@@ -156,8 +318,9 @@ def history():
     
     if end_date:
         try:
-            end = datetime.strptime(end_date, '%Y-%m-%d')
-            query = query.filter(SensorData.timestamp <= end)
+            # Khoảng nửa mở [start, end + 1 ngày) để dùng được index timestamp
+            end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+            query = query.filter(SensorData.timestamp < end)
         except:
             pass
     
@@ -166,10 +329,20 @@ def history():
     return render_template('history.html', data=data, user=current_user)
 
 # ================== XUẤT PDF ==================
-@app.route('/export/pdf')
-@login_required
-def export_pdf():
-    # Tạo file PDF
+# Bố cục báo cáo cố định, dựng một lần khi import
+_PDF_LINES = (
+    "Nhiệt độ: {0.temperature}°C",
+    "Độ ẩm: {0.humidity}%",
+    "Ánh sáng: {0.light} lux",
+    "Chất lượng không khí: {0.air_quality} ppm",
+    "Mức âm thanh: {0.sound_level} dB",
+    "Đánh giá: {0.evaluation}",
+)
+
+# Nội dung PDF chỉ phụ thuộc vào bản ghi mới nhất và phút xuất báo cáo,
+# nên cache bytes đã render để các lần bấm lặp lại không dựng lại layout
+@lru_cache(maxsize=8)
+def _build_pdf(latest_data, exported_at):
     buffer = io.BytesIO()
     p = canvas.Canvas(buffer, pagesize=A4)
     width, height = A4
@@ -178,29 +351,36 @@ def export_pdf():
     p.setFont("Helvetica-Bold", 16)
     p.drawString(50, height - 50, "BÁO CÁO CLASSGUARD")
     p.setFont("Helvetica", 12)
-    p.drawString(50, height - 80, f"Ngày xuất: {datetime.now().strftime('%d/%m/%Y %H:%M')}")
-    
-    # Lấy dữ liệu gần nhất
-    latest_data = SensorData.query.order_by(SensorData.timestamp.desc()).first()
+    p.drawString(50, height - 80, f"Ngày xuất: {exported_at}")
     
     if latest_data:
-        y = height - 120
-        p.drawString(50, y, f"Nhiệt độ: {latest_data.temperature}°C")
-        y -= 25
-        p.drawString(50, y, f"Độ ẩm: {latest_data.humidity}%")
-        y -= 25
-        p.drawString(50, y, f"Ánh sáng: {latest_data.light} lux")
-        y -= 25
-        p.drawString(50, y, f"Chất lượng không khí: {latest_data.air_quality} ppm")
-        y -= 25
-        p.drawString(50, y, f"Mức âm thanh: {latest_data.sound_level} dB")
-        y -= 25
-        p.drawString(50, y, f"Đánh giá: {latest_data.evaluation}")
+        # Một text object cho cả khối thay vì sáu lần drawString
+        text = p.beginText(50, height - 120)
+        text.setFont("Helvetica", 12)
+        text.setLeading(25)
+        text.textLines([line.format(latest_data) for line in _PDF_LINES])
+        p.drawText(text)
     
     p.save()
-    buffer.seek(0)
+    return buffer.getvalue()
+
+@app.route('/export/pdf')
+@login_required
+def export_pdf():
+    # Lấy dữ liệu gần nhất
+    latest_data = SensorData.query.with_entities(
+        SensorData.temperature,
+        SensorData.humidity,
+        SensorData.light,
+        SensorData.air_quality,
+        SensorData.sound_level,
+        SensorData.evaluation,
+    ).order_by(SensorData.timestamp.desc()).first()
+    
+    # Tạo file PDF
+    pdf = _build_pdf(latest_data, datetime.now().strftime('%d/%m/%Y %H:%M'))
     
-    return send_file(buffer, as_attachment=True, download_name='classguard_report.pdf', mimetype='application/pdf')
+    return send_file(io.BytesIO(pdf), as_attachment=True, download_name='classguard_report.pdf', mimetype='application/pdf')
 
 # ================== QUẢN LÝ NGƯỜI DÙNG (chỉ admin) ==================
 @app.route('/admin/users')
@@ -249,6 +429,7 @@ def create_sample_data():
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        ensure_indexes(db.engine)
         # Chỉ chạy dòng dưới lần đầu để tạo dữ liệu mẫu
         # create_sample_data()
     
@@ -0,0 +1,35 @@
+# Cấu hình gunicorn, tự động được nạp khi chạy từ thư mục web_server
+import os
+
+def on_starting(server):
+    # Bổ sung index còn thiếu một lần ở master, trước khi fork worker, để các
+    # worker không chạy DDL đồng thời. Không import app ở đây: requests/ssl
+    # phải được import sau khi gevent monkey-patch trong worker.
+    from sqlalchemy import create_engine
+    from sqlalchemy.engine import make_url
+    from models import ensure_indexes, get_database_url
+    
+    url = make_url(get_database_url())
+    if url.get_backend_name() == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            return
+        if not os.path.isabs(url.database):
+            # Flask-SQLAlchemy đặt file SQLite tương đối trong thư mục instance
+            instance_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+            url = url.set(database=os.path.join(instance_path, url.database))
+        if not os.path.exists(url.database):
+            # Database mới: db.create_all() sẽ tạo cả index
+            return
+    
+    engine = create_engine(url)
+    try:
+        ensure_indexes(engine)
+    finally:
+        engine.dispose()
+
+def post_fork(server, worker):
+    # psycopg2 chặn trong C: cho nó nhường vòng lặp gevent khi chờ Postgres,
+    # để một truy vấn chậm không làm đứng mọi greenlet trong worker
+    if server.cfg.worker_class_str == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
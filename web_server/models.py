@@ -0,0 +1,45 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from flask_login import UserMixin
+from datetime import datetime
+import os
+
+db = SQLAlchemy()
+
+# ================== MÔ HÌNH DỮ LIỆU ==================
+class User(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    password = db.Column(db.String(120), nullable=False)
+    role = db.Column(db.String(20), default='viewer')  # 'admin' hoặc 'viewer'
+
+class SensorData(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    temperature = db.Column(db.Float)
+    humidity = db.Column(db.Float)
+    light = db.Column(db.Float)
+    air_quality = db.Column(db.Float)
+    sound_level = db.Column(db.Float)
+    evaluation = db.Column(db.String(50))
+    device_ip = db.Column(db.String(50))
+
+    # Lịch sử lọc theo thiết bị rồi sắp xếp theo thời gian giảm dần
+    __table_args__ = (
+        db.Index('ix_sensor_device_ts', 'device_ip', timestamp.desc()),
+    )
+
+def get_database_url():
+    # Render/Fly cấp Postgres qua DATABASE_URL; mặc định dùng SQLite cục bộ
+    database_url = os.environ.get('DATABASE_URL', 'sqlite:///classguard.db')
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    return database_url
+
+def ensure_indexes(engine):
+    # db.create_all() chỉ tạo index cho bảng mới; database đã triển khai
+    # cần tạo bổ sung. checkfirst nên gọi lại nhiều lần vẫn an toàn.
+    if not inspect(engine).has_table(SensorData.__tablename__):
+        return
+    for index in SensorData.__table__.indexes:
+        index.create(engine, checkfirst=True)
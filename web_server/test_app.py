@@ -0,0 +1,20 @@
+import os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app
+
+
+def test_session_round_trip_keeps_tagged_values():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['t'] = (1, 2)
+        sess['b'] = b'yy'
+
+    # Flask-Login flash một tuple khi chưa đăng nhập mà vào trang bảo vệ
+    client.get('/')
+
+    with client.session_transaction() as sess:
+        assert sess['t'] == (1, 2)
+        assert sess['b'] == b'yy'
+        assert sess['_flashes'] == [('message', 'Please log in to access this page.')]